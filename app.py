@@ -1,128 +1,675 @@
 import streamlit as st
-from anthropic import AsyncAnthropic
+from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient, APIConnectionError, APIStatusError
+import httpx
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 import json
-from typing import List, Dict
+from typing import Any, List, Dict, Tuple, Optional, Callable, Awaitable
 import asyncio
+from functools import partial
 import time
 from datetime import datetime
+from collections import OrderedDict
 import re
+import sqlite3
+import threading
+import uuid
+
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    # Semantic lookups are optional; the exact-match cache works without them
+    np = None
+    SentenceTransformer = None
+
+try:
+    # orjson raises a subclass of json.JSONDecodeError, so existing handlers still apply
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Built once so cleaning runs in C rather than a per-character Python loop
+_CONTROL_BYTES = bytes(i for i in range(32) if i not in (9, 10, 13))
 
 def clean_text_for_json(text: str) -> str:
     """Clean text to make it JSON-compatible"""
-    # Remove control characters
-    text = ''.join(char for char in text if ord(char) >= 32 or char in '\n\r\t')
+    # Remove any potential Unicode issues, then control characters, in single C-level passes
+    text = text.encode('ascii', 'ignore').translate(None, _CONTROL_BYTES).decode('ascii')
     
     # Handle escaped characters
-    text = text.replace('\n', '\\n').replace('\r', '\\r').replace('\t', '\\t')
+    return text.replace('\n', '\\n').replace('\r', '\\r').replace('\t', '\\t')
+
+# Characters that can change brace depth or string state; everything else is skipped in C
+_JSON_STRUCTURAL_RE = re.compile(r'[{}"\\]')
+
+def find_first_json_object(s: str) -> Optional[Tuple[int, int]]:
+    """Return the (start, end) span of the first balanced top-level {...} in s, or None"""
+    depth = 0
+    start = -1
+    in_string = False
+    skip_to = 0
+    
+    for match in _JSON_STRUCTURAL_RE.finditer(s):
+        i = match.start()
+        if i < skip_to:
+            # Character escaped by the preceding backslash
+            continue
+        
+        char = match.group()
+        if in_string:
+            if char == '\\':
+                skip_to = i + 2
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            if depth > 0:
+                in_string = True
+        elif char == '{':
+            if depth == 0:
+                start = i
+            depth += 1
+        elif char == '}' and depth > 0:
+            depth -= 1
+            if depth == 0:
+                return start, i + 1
+    
+    return None
+
+class JSONStreamParser:
+    """Incrementally scan streamed text and emit top-level JSON string fields as they close"""
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.expect_key = False
+        self.is_key = False
+        self.key = None
+        self.buffer = []
+        self.fields = {}
+        self.done = False
+    
+    @staticmethod
+    def decode_string(raw: str) -> str:
+        try:
+            return json_loads(f'"{raw}"')
+        except json.JSONDecodeError:
+            pass
+        try:
+            # strict=False tolerates raw newlines the model leaves unescaped
+            return json.loads(f'"{raw}"', strict=False)
+        except json.JSONDecodeError:
+            return raw
+    
+    def feed(self, chunk: str) -> List[Tuple[str, str]]:
+        events = []
+        for char in chunk:
+            if self.done:
+                break
+            
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.depth == 1:
+                        value = self.decode_string(''.join(self.buffer))
+                        if self.is_key:
+                            self.key = value
+                        elif self.key is not None:
+                            self.fields[self.key] = value
+                            events.append((self.key, value))
+                            self.key = None
+                    self.buffer = []
+                    continue
+                if self.depth == 1:
+                    self.buffer.append(char)
+            
+            elif self.depth == 0:
+                # Skip any prose before the JSON object starts
+                if char == '{':
+                    self.depth = 1
+                    self.expect_key = True
+            
+            elif char == '"':
+                self.in_string = True
+                self.is_key = self.depth == 1 and self.expect_key
+            elif char in '{[':
+                self.depth += 1
+            elif char in '}]':
+                self.depth -= 1
+                if self.depth == 0:
+                    self.done = True
+            elif self.depth == 1:
+                if char == ':':
+                    self.expect_key = False
+                elif char == ',':
+                    self.expect_key = True
+                    self.key = None
+        
+        return events
+    
+    def partial_value(self) -> Optional[Tuple[str, str]]:
+        """Return the key and text so far of a top-level string value that is still streaming"""
+        if not (self.in_string and self.depth == 1 and not self.is_key and self.key is not None):
+            return None
+        
+        raw = ''.join(self.buffer)
+        if self.escape:
+            # Drop a trailing backslash whose escaped character hasn't arrived yet
+            raw = raw[:-1]
+        return self.key, self.decode_string(raw)
+
+# Error types Anthropic reports for overload and server faults, including inside a 200 stream
+RETRYABLE_ERROR_TYPES = {"overloaded_error", "rate_limit_error", "api_error"}
+
+def is_transient_error(error: BaseException) -> bool:
+    if isinstance(error, APIConnectionError):
+        return True
+    if not isinstance(error, APIStatusError):
+        return False
+    if error.status_code in (408, 409, 429) or error.status_code >= 500:
+        return True
+    # Errors raised mid-stream arrive on the original 200 response, so check the error type instead
+    body = error.body if isinstance(error.body, dict) else {}
+    return body.get("error", {}).get("type") in RETRYABLE_ERROR_TYPES
+
+_backoff = wait_random_exponential(min=0.5, max=8)
+
+def retry_wait(retry_state) -> float:
+    """Honor the server's Retry-After header, otherwise back off exponentially with jitter"""
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    if response is not None:
+        try:
+            return min(float(response.headers.get("retry-after")), 60.0)
+        except (TypeError, ValueError):
+            pass
+    return _backoff(retry_state)
+
+# Marks the fallback reply returned when an agent call fails
+PROCESSING_ERROR_THOUGHTS = "Error occurred during processing"
+
+# Shown when max_tokens ran out before the model started the response field
+TRUNCATED_RESPONSE = "The reply was cut off by the max tokens limit before a response was written. Try raising the limit in the sidebar."
+
+# Streamed text is pushed to the UI in batches of at least this many characters or this often
+UI_FLUSH_CHARS = 32
+UI_FLUSH_SECONDS = 0.05
+
+# Agent key for progress notes that concurrent tasks send through on_update instead of writing to the status box
+STATUS_UPDATE = "status"
+
+# Forcing the model to call this tool makes the API return the fields as structured input
+REPLY_TOOL = {
+    "name": "reply",
+    "description": "Submit your analytical process and your final response.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "thoughts": {"type": "string", "description": "Your analytical process"},
+            "response": {"type": "string", "description": "Your actual response"}
+        },
+        "required": ["thoughts", "response"]
+    }
+}
+
+# Identical for every agent, so with the reply tool it forms one prompt-cache prefix shared by all calls
+SHARED_SYSTEM_PROMPT = """Work collaboratively with other agents to solve tasks.
+Always answer by calling the reply tool, with your analytical process in "thoughts" and your actual response in "response"."""
+
+class SemanticCache:
+    """Exact-match LRU cache backed by an embedding nearest-neighbour lookup for near-duplicate inputs"""
+    def __init__(self, encoder=None, max_size: int = 256, threshold: float = 0.92):
+        self.encoder = encoder
+        self.max_size = max_size
+        self.threshold = threshold
+        self.exact = OrderedDict()
+        # Per agent: (N, D) matrix of unit-length embeddings and the parallel list of responses
+        self.embeddings = {}
+        self.responses = {}
+        self.hits = 0
+        self.misses = 0
+    
+    def embed(self, text: str) -> "np.ndarray":
+        vector = np.asarray(self.encoder.encode(text), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+    
+    async def lookup(self, agent_name: str, input_text: str,
+                     semantic_text: Optional[str] = None) -> Tuple[Optional[Dict], Optional["np.ndarray"]]:
+        """Return a cached response (or None) plus the query embedding to store on a miss.
+        
+        semantic_text, when given, is embedded instead of input_text. Templated prompts pass just
+        their variable part so the fixed template doesn't swamp the similarity score.
+        """
+        key = (agent_name, input_text)
+        if key in self.exact:
+            self.exact.move_to_end(key)
+            self.hits += 1
+            return dict(self.exact[key]), None
+        
+        vector = None
+        if self.encoder is not None:
+            # Encoding is CPU-bound, so keep it off the event loop
+            vector = await asyncio.to_thread(self.embed, semantic_text or input_text)
+            if agent_name in self.embeddings:
+                # Stored vectors are normalized, so one matrix-vector product gives cosine similarity
+                scores = self.embeddings[agent_name] @ vector
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self.hits += 1
+                    return dict(self.responses[agent_name][best]), vector
+        
+        self.misses += 1
+        return None, vector
+    
+    def store(self, agent_name: str, input_text: str, response: Dict, vector: Optional["np.ndarray"] = None):
+        self.exact[(agent_name, input_text)] = response
+        self.exact.move_to_end((agent_name, input_text))
+        if len(self.exact) > self.max_size:
+            self.exact.popitem(last=False)
+        
+        if vector is not None:
+            if agent_name in self.embeddings:
+                self.embeddings[agent_name] = np.vstack([self.embeddings[agent_name], vector])[-self.max_size:]
+                self.responses[agent_name] = (self.responses[agent_name] + [response])[-self.max_size:]
+            else:
+                self.embeddings[agent_name] = vector[np.newaxis, :]
+                self.responses[agent_name] = [response]
+
+class HistoryStore:
+    """Append-only SQLite log of agent outputs that survives reruns and can be replayed per session"""
+    def __init__(self, path: str = "history.db"):
+        # One connection is shared by every session's script thread, so serialize access
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages (session_id TEXT, agent TEXT, ts REAL, thoughts TEXT, response TEXT)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id, ts)")
     
-    # Remove any potential Unicode issues
-    text = text.encode('ascii', 'ignore').decode('ascii')
+    def append(self, session_id: str, agent: str, thoughts: str, response: str):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO messages (session_id, agent, ts, thoughts, response) VALUES (?, ?, ?, ?, ?)",
+                (session_id, agent, time.time(), thoughts, response)
+            )
     
-    return text
+    def load(self, session_id: str) -> List[Tuple[str, str, str]]:
+        with self.lock:
+            return self.conn.execute(
+                "SELECT agent, thoughts, response FROM messages WHERE session_id = ? ORDER BY ts",
+                (session_id,)
+            ).fetchall()
 
 class Agent:
-    def __init__(self, name: str, role: str, client: AsyncAnthropic):
+    def __init__(self, name: str, role: str, client: AsyncAnthropic, model: str, max_tokens: int,
+                 cache: Optional[SemanticCache] = None, history: Optional[HistoryStore] = None):
         self.name = name
         self.role = role
         self.client = client
-        self.conversation_history = []
+        self.model = model
+        self.max_tokens = max_tokens
+        self.cache = cache
+        self.history = history
+        self.session_id = None
     
     def get_system_prompt(self) -> str:
-        return f"""You are {self.name}, a {self.role}. 
-        Work collaboratively with other agents to solve tasks.
-        Your response must be only a valid JSON string in this exact format, with no additional text or formatting:
-        {{"thoughts": "your analytical process", "response": "your actual response"}}
-        Keep all newlines and special characters properly escaped in your JSON."""
+        return f"You are {self.name}, a {self.role}."
     
-    async def process(self, input_text: str) -> Dict:
-        try:
-            message = await self.client.messages.create(
-                model="claude-3-sonnet-20240229",
-                max_tokens=1000,
-                messages=[{
-                    "role": "user",
-                    "content": f"Task input: {input_text}\n\nProvide your response as a single JSON object with 'thoughts' and 'response' fields only. No other text or formatting."
-                }],
-                system=self.get_system_prompt(),
-                temperature=0.7
-            )
-            
-            # Get the response text and clean it
-            response_text = message.content[0].text.strip()
-            
-            # Try to extract JSON if it's wrapped in other text
-            json_match = re.search(r'\{[\s\S]*\}', response_text)
-            if json_match:
-                response_text = json_match.group(0)
+    def build_request(self, input_text: str, max_tokens: Optional[int] = None) -> Dict:
+        """Build the Messages API parameters shared by the live and batch paths"""
+        return {
+            "model": self.model,
+            "max_tokens": max_tokens or self.max_tokens,
+            "messages": [{
+                "role": "user",
+                "content": f"Task input: {input_text}"
+            }],
+            # The agent-specific block comes after the cached prefix so the prefix stays byte-identical
+            "system": [
+                {"type": "text", "text": SHARED_SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}},
+                {"type": "text", "text": self.get_system_prompt()}
+            ],
+            "tools": [REPLY_TOOL],
+            "tool_choice": {"type": "tool", "name": REPLY_TOOL["name"]},
+            "temperature": 0.7
+        }
+    
+    def parse_message(self, message) -> Dict:
+        """Read the reply tool input from a complete message, falling back to its text"""
+        for block in message.content:
+            if block.type == "tool_use":
+                response_json = dict(block.input)
+                response_json.setdefault("response", TRUNCATED_RESPONSE)
+                return self.record_response(response_json)
+        
+        return self.parse_response("".join(block.text for block in message.content if block.type == "text"))
+    
+    def parse_response(self, response_text: str, parser: Optional[JSONStreamParser] = None) -> Dict:
+        """Fallback for replies that arrive as JSON text rather than tool input"""
+        if parser is None:
+            parser = JSONStreamParser()
+            parser.feed(response_text)
+        
+        if "response" in parser.fields:
+            response_json = dict(parser.fields)
+        elif parser.depth > 0:
+            # The object never closed (usually max_tokens), so keep the text that already streamed
+            response_json = dict(parser.fields)
+            partial = parser.partial_value()
+            if partial:
+                response_json[partial[0]] = partial[1]
+            response_json.setdefault("response", TRUNCATED_RESPONSE)
+        else:
+            # Extract the JSON object if it's wrapped in other text
+            response_text = response_text.strip()
+            span = find_first_json_object(response_text)
+            if span:
+                response_text = response_text[span[0]:span[1]]
             
             # Clean the text for JSON parsing
             cleaned_text = clean_text_for_json(response_text)
             
             try:
                 # Try to parse the cleaned JSON
-                response_json = json.loads(cleaned_text)
+                response_json = json_loads(cleaned_text)
             except json.JSONDecodeError:
                 # If JSON parsing fails, create a structured response from the text
                 response_json = {
                     "thoughts": "Processed the input and structured the response",
-                    "response": cleaned_text
+                    "response": response_text
                 }
-
-            # Clean the values in the response
-            response_json["thoughts"] = clean_text_for_json(str(response_json.get("thoughts", "")))
-            response_json["response"] = clean_text_for_json(str(response_json.get("response", "")))
-
-            self.conversation_history.append({
-                "role": self.name,
-                "content": response_json["response"]
-            })
+        
+        return self.record_response(response_json)
+    
+    def record_response(self, response_json: Dict) -> Dict:
+        # Parsed values are already plain strings; Streamlit renders newlines and control characters fine
+        response_json["thoughts"] = str(response_json.get("thoughts", ""))
+        response_json["response"] = str(response_json.get("response", ""))
+        return response_json
+    
+    def remember(self, history_key: str, response_json: Dict):
+        """Save a reply under the card key it is shown with, so a resumed session lays out the same cards"""
+        if self.history and self.session_id:
+            self.history.append(self.session_id, history_key, response_json["thoughts"], response_json["response"])
+    
+    @retry(
+        retry=retry_if_exception(is_transient_error),
+        wait=retry_wait,
+        stop=stop_after_attempt(4),
+        reraise=True
+    )
+    async def stream_reply(self, input_text: str, on_update: Optional[Callable[[str, str], None]] = None
+                           ) -> Tuple[List[str], JSONStreamParser, Any]:
+        """Stream one reply, restarting from scratch if a transient error interrupts it"""
+        parser = JSONStreamParser()
+        chunks = []
+        pending = 0
+        last_flush = time.monotonic()
+        
+        # Retries are handled here for the whole stream, so turn off the SDK's own request retries
+        client = self.client.with_options(max_retries=0)
+        async with client.messages.stream(**self.build_request(input_text)) as stream:
+            async for event in stream:
+                # Tool input arrives as partial JSON, which the parser reads the same way as text
+                if event.type == "input_json":
+                    delta = event.partial_json
+                elif event.type == "text":
+                    delta = event.text
+                else:
+                    continue
+                
+                chunks.append(delta)
+                for key, value in parser.feed(delta):
+                    if on_update:
+                        on_update(key, value)
+                
+                # Coalesce partial values so the UI isn't redrawn once per token
+                if on_update:
+                    pending += len(delta)
+                    partial = parser.partial_value()
+                    if partial and (pending >= UI_FLUSH_CHARS or time.monotonic() - last_flush > UI_FLUSH_SECONDS):
+                        on_update(*partial)
+                        pending = 0
+                        last_flush = time.monotonic()
+            
+            # Read through message_stop: final output token counts and stop_reason only arrive in message_delta
+            message = await stream.get_final_message()
+        
+        return chunks, parser, message
+    
+    async def process(self, input_text: str, on_update: Optional[Callable[[str, str], None]] = None,
+                      cache_scope: str = "", semantic_text: Optional[str] = None,
+                      history_key: Optional[str] = None) -> Dict:
+        # Calls whose inputs differ only in a few words (e.g. research angles) get separate scopes
+        # so near-duplicate matching can't return one sub-query's answer for another; switching
+        # models also starts a fresh scope
+        cache_name = ":".join(part for part in (self.name, self.model, cache_scope) if part)
+        try:
+            vector = None
+            if self.cache:
+                cached, vector = await self.cache.lookup(cache_name, input_text, semantic_text)
+                if cached:
+                    if on_update:
+                        on_update("thoughts", cached["thoughts"])
+                        on_update("response", cached["response"])
+                    if history_key:
+                        self.remember(history_key, cached)
+                    return cached
+            
+            chunks, parser, message = await self.stream_reply(input_text, on_update)
+            response_json = self.parse_response(''.join(chunks), parser)
+            # Only calls given a history_key are saved; internal steps like distilling are not
+            if history_key:
+                self.remember(history_key, response_json)
+            
+            # Truncated or unparseable replies are shown once but never served again from the cache
+            truncated = message.stop_reason == "max_tokens" or "response" not in parser.fields
+            if self.cache and not truncated:
+                self.cache.store(cache_name, input_text, dict(response_json), vector)
+            response_json["truncated"] = truncated
             
+            # Usage belongs to this call, not the agent, since one agent can serve several concurrent calls
+            response_json["usage"] = message.usage
             return response_json
 
         except Exception as e:
-            st.error(f"Processing error: {str(e)}")
+            # Calls running in concurrent tasks must not touch Streamlit, so report through on_update when given
+            if on_update:
+                on_update("error", f"Processing error: {str(e)}")
+            else:
+                st.error(f"Processing error: {str(e)}")
             # Create a safe fallback response
             return {
-                "thoughts": "Error occurred during processing",
+                "thoughts": PROCESSING_ERROR_THOUGHTS,
                 "response": f"I encountered an error while processing the input: {str(e)}. Please try rephrasing your request."
             }
 
 class MultiAgentSystem:
-    def __init__(self, api_key: str):
-        self.client = AsyncAnthropic(api_key=api_key)
+    PROMPTS = {
+        "researcher": "Analyze this topic and provide key points: {task}",
+        "research_angle": "For the task '{task}', focus only on: {angle}. Answer in at most three short bullet points.",
+        "writer": "Using these research points: {research}\nCreate a well-structured explanation of: {task}",
+        "fact_checker": "Fact-check these research points about {task}:\n{research}\nFlag anything inaccurate, outdated or unsupported.",
+        "critic": "Review this explanation of {task}:\n{draft}\nFact-check notes on the underlying research:\n{fact_check}\nProvide specific feedback and suggestions.",
+        "distiller": "Compress the following into at most 10 short bullet points, keeping every concrete fact, name and number:\n{text}"
+    }
+    
+    # Upstream output shorter than this (roughly 300 tokens) is passed on as-is rather than distilled
+    DISTILL_MIN_CHARS = 1200
+    
+    # Independent research sub-queries issued concurrently in the interactive workflow
+    RESEARCH_ANGLES = ["core definition", "key mechanisms", "notable examples", "common misconceptions"]
+    
+    # Extraction and review work goes to the faster, cheaper model; the Writer stays on Sonnet for quality
+    MODELS = {
+        "researcher": "claude-3-5-haiku-latest",
+        "writer": "claude-3-5-sonnet-latest",
+        "fact_checker": "claude-3-5-haiku-latest",
+        "critic": "claude-3-5-haiku-latest",
+        "distiller": "claude-3-5-haiku-latest"
+    }
+    
+    # Latency grows with output length, so only the Writer gets room for long answers
+    MAX_TOKENS = {
+        "researcher": 400,
+        "writer": 1000,
+        "fact_checker": 500,
+        "critic": 500,
+        # Room for the thoughts field the reply tool asks for first, plus ten short bullets
+        "distiller": 450
+    }
+    
+    # The batch path keeps the single open-ended research prompt, which needs more room than one angle
+    BATCH_MAX_TOKENS = {
+        "researcher": 1000
+    }
+    
+    def __init__(self, api_key: str, cache: Optional[SemanticCache] = None, history: Optional[HistoryStore] = None):
+        # HTTP/2 lets concurrent agent calls share one multiplexed TLS connection
+        self.client = AsyncAnthropic(
+            api_key=api_key,
+            http_client=DefaultAsyncHttpxClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+            ),
+            # The SDK applies its own timeout to every request, so it is set here rather than on the HTTP client
+            timeout=httpx.Timeout(60.0, connect=5.0)
+        )
+        self.cache = cache
+        self.history = history
         self.agents = {
-            "researcher": Agent("Researcher", "research and data analysis expert", self.client),
-            "writer": Agent("Writer", "content creation expert", self.client),
-            "critic": Agent("Critic", "quality control expert", self.client)
+            "researcher": Agent("Researcher", "research and data analysis expert", self.client,
+                                self.MODELS["researcher"], self.MAX_TOKENS["researcher"], cache, history),
+            "writer": Agent("Writer", "content creation expert", self.client,
+                            self.MODELS["writer"], self.MAX_TOKENS["writer"], cache, history),
+            "fact_checker": Agent("Fact Checker", "fact verification expert", self.client,
+                                  self.MODELS["fact_checker"], self.MAX_TOKENS["fact_checker"], cache, history),
+            "critic": Agent("Critic", "quality control expert", self.client,
+                            self.MODELS["critic"], self.MAX_TOKENS["critic"], cache, history),
+            "distiller": Agent("Distiller", "summarization expert", self.client,
+                               self.MODELS["distiller"], self.MAX_TOKENS["distiller"], cache, history)
         }
     
-    async def run_workflow(self, task: str) -> List[Dict]:
+    def set_session(self, session_id: str):
+        for agent in self.agents.values():
+            agent.session_id = session_id
+    
+    def configure(self, models: Dict[str, str], max_tokens: Dict[str, int]):
+        for agent_key, agent in self.agents.items():
+            agent.model = models.get(agent_key, agent.model)
+            agent.max_tokens = max_tokens.get(agent_key, agent.max_tokens)
+    
+    async def distill(self, text: str, notify: Optional[Callable[[str, str], None]] = None) -> str:
+        """Compress long upstream output with a cheap model before it's embedded in the next prompt"""
+        if len(text) <= self.DISTILL_MIN_CHARS:
+            return text
+        
+        def on_update(field: str, value: str):
+            # The distilled text isn't shown on its own card; only pass errors along
+            if notify and field == "error":
+                notify(field, value)
+        
+        if notify:
+            notify("write", "🗜️ Distiller agent is condensing the research...")
+        result = await self.agents["distiller"].process(self.PROMPTS["distiller"].format(text=text), on_update=on_update)
+        
+        # Fall back to the full text rather than pass an error message or a cut-off summary downstream
+        if result["thoughts"] == PROCESSING_ERROR_THOUGHTS or result.get("truncated"):
+            return text
+        return result["response"]
+    
+    async def run_parallel(self, status, jobs: Dict[str, Awaitable[Dict]]) -> Dict[str, Dict]:
+        """Run independent agent calls concurrently, reporting each one as it finishes"""
+        async def labelled(label: str, job: Awaitable[Dict]) -> Tuple[str, Dict]:
+            return label, await job
+        
+        tasks = [asyncio.create_task(labelled(label, job)) for label, job in jobs.items()]
+        outputs = {}
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                label, output = await next_done
+                status.write(f"✅ {label} finished")
+                outputs[label] = output
+        finally:
+            for task in tasks:
+                task.cancel()
+        
+        return outputs
+    
+    async def run_workflow(self, task: str, on_update: Optional[Callable[[str, str, str], None]] = None) -> List[Dict]:
         results = []
         
+        def forward(agent_key: str) -> Optional[Callable[[str, str], None]]:
+            return partial(on_update, agent_key) if on_update else None
+        
         with st.status("Running workflow...", expanded=True) as status:
             try:
-                # Research phase
+                # Research phase, fanned out into one concurrent sub-query per angle
                 status.write("🔍 Researcher agent is analyzing the task...")
-                research_result = await self.agents["researcher"].process(
-                    f"Analyze this topic and provide key points: {task}"
-                )
-                results.append({"agent": "researcher", "output": research_result})
+                research_outputs = await self.run_parallel(status, {
+                    f"Researcher ({angle})": self.agents["researcher"].process(
+                        self.PROMPTS["research_angle"].format(task=task, angle=angle),
+                        on_update=forward(f"researcher: {angle}"),
+                        history_key=f"researcher: {angle}",
+                        cache_scope=angle,
+                        # The angle template dominates the prompt, so match near-duplicates on the task alone
+                        semantic_text=task
+                    )
+                    for angle in self.RESEARCH_ANGLES
+                })
+                research_points = []
+                for angle in self.RESEARCH_ANGLES:
+                    angle_result = research_outputs[f"Researcher ({angle})"]
+                    results.append({"agent": f"researcher: {angle}", "output": angle_result})
+                    research_points.append(f"{angle.capitalize()}:\n{angle_result['response']}")
+                research_summary = "\n\n".join(research_points)
                 
-                # Writing phase
-                status.write("✍️ Writer agent is creating content...")
-                write_result = await self.agents["writer"].process(
-                    f"Using these research points: {research_result['response']}\nCreate a well-structured explanation of: {task}"
-                )
+                # Only the Writer reads the distilled research, so the Fact Checker
+                # starts at once instead of waiting on the distill round trip. This runs as
+                # a concurrent task, so its notes go through on_update rather than the status box
+                async def distill_then_write() -> Dict:
+                    notify = forward(STATUS_UPDATE)
+                    writer_research = await self.distill(research_summary, notify)
+                    if notify:
+                        notify("write", "✍️ Writer agent is creating content...")
+                    return await self.agents["writer"].process(
+                        self.PROMPTS["writer"].format(task=task, research=writer_research),
+                        on_update=forward("writer"),
+                        history_key="writer"
+                    )
+                
+                # Writing and fact-checking only depend on the research, so run them together
+                status.write("🔎 Fact Checker agent is verifying the research...")
+                outputs = await self.run_parallel(status, {
+                    "Writer": distill_then_write(),
+                    "Fact Checker": self.agents["fact_checker"].process(
+                        self.PROMPTS["fact_checker"].format(task=task, research=research_summary),
+                        on_update=forward("fact_checker"),
+                        history_key="fact_checker"
+                    )
+                })
+                write_result = outputs["Writer"]
+                fact_check_result = outputs["Fact Checker"]
                 results.append({"agent": "writer", "output": write_result})
+                results.append({"agent": "fact_checker", "output": fact_check_result})
                 
                 # Review phase
                 status.write("📝 Critic agent is reviewing the content...")
                 review_result = await self.agents["critic"].process(
-                    f"Review this explanation of {task}:\n{write_result['response']}\nProvide specific feedback and suggestions."
+                    self.PROMPTS["critic"].format(task=task, draft=write_result["response"], fact_check=fact_check_result["response"]),
+                    on_update=forward("critic"),
+                    history_key="critic"
                 )
                 results.append({"agent": "critic", "output": review_result})
                 
-                status.update(label="Workflow completed!", state="complete")
+                label = "Workflow completed!"
+                if self.cache:
+                    label += f" (cache: {self.cache.hits} hits, {self.cache.misses} misses)"
+                status.update(label=label, state="complete")
             
             except Exception as e:
                 status.update(label=f"Error: {str(e)}", state="error")
@@ -130,16 +677,189 @@ class MultiAgentSystem:
                 return []
         
         return results
+    
+    async def run_batch_phase(self, status, job: Dict, phase: str, requests: Dict[str, Tuple[str, str]],
+                              poll_interval: float) -> Dict[str, Dict]:
+        """Submit one Message Batch (custom_id -> (agent key, input)) and wait for its results.
+        
+        Batch ids and finished outputs are recorded on job, so a later run resumes polling
+        instead of submitting (and paying for) the same batch again.
+        """
+        if phase in job["outputs"]:
+            return job["outputs"][phase]
+        
+        if phase in job["batch_ids"]:
+            batch = await self.client.messages.batches.retrieve(job["batch_ids"][phase])
+        else:
+            batch = await self.client.messages.batches.create(requests=[
+                {
+                    "custom_id": custom_id,
+                    "params": self.agents[agent_key].build_request(input_text, self.batch_max_tokens(agent_key))
+                }
+                for custom_id, (agent_key, input_text) in requests.items()
+            ])
+            job["batch_ids"][phase] = batch.id
+        
+        # Touch the UI on every poll so a rerun or the Discard button can interrupt the wait
+        while batch.processing_status != "ended":
+            counts = batch.request_counts
+            status.update(label=f"Waiting on {phase} batch: {counts.succeeded + counts.errored} done, "
+                                f"{counts.processing} processing...")
+            await asyncio.sleep(poll_interval)
+            batch = await self.client.messages.batches.retrieve(batch.id)
+        
+        outputs = {}
+        async for entry in await self.client.messages.batches.results(batch.id):
+            agent_key = requests[entry.custom_id][0]
+            if entry.result.type == "succeeded":
+                outputs[entry.custom_id] = self.agents[agent_key].parse_message(entry.result.message)
+                self.agents[agent_key].remember(agent_key, outputs[entry.custom_id])
+        
+        # Errored, canceled or expired requests get the same fallback as a failed live call
+        for custom_id in requests:
+            outputs.setdefault(custom_id, {
+                "thoughts": PROCESSING_ERROR_THOUGHTS,
+                "response": "The batch request for this step did not succeed. Please try running the task again."
+            })
+        
+        job["outputs"][phase] = outputs
+        return outputs
+    
+    def batch_max_tokens(self, agent_key: str) -> Optional[int]:
+        """Batch default for an agent's limit, unless the user moved its sidebar slider off the default"""
+        if self.agents[agent_key].max_tokens != self.MAX_TOKENS[agent_key]:
+            return None
+        return self.BATCH_MAX_TOKENS.get(agent_key)
+    
+    async def cancel_batch(self, job: Dict):
+        """Cancel the batch of any phase that was submitted but hasn't returned its results yet"""
+        for phase, batch_id in job["batch_ids"].items():
+            if phase not in job["outputs"]:
+                await self.client.messages.batches.cancel(batch_id)
+    
+    async def run_batch(self, job: Dict, poll_interval: float = 10.0) -> List[List[Dict]]:
+        """Run the workflow for many tasks at once through the Message Batches API, one batch per phase"""
+        tasks = job["tasks"]
+        results = [[] for _ in tasks]
+        
+        with st.status(f"Running batch of {len(tasks)} tasks...", expanded=True) as status:
+            try:
+                # custom_id only allows letters, digits, '-' and '_'
+                status.write("🔍 Submitted research batch...")
+                research = await self.run_batch_phase(status, job, "research", {
+                    f"{i}-researcher": ("researcher", self.PROMPTS["researcher"].format(task=task))
+                    for i, task in enumerate(tasks)
+                }, poll_interval)
+                
+                status.write("✍️ Submitted writing and fact-checking batch...")
+                drafts = await self.run_batch_phase(status, job, "drafts", {
+                    f"{i}-{agent_key}": (agent_key, self.PROMPTS[agent_key].format(task=task, research=research[f"{i}-researcher"]["response"]))
+                    for i, task in enumerate(tasks)
+                    for agent_key in ("writer", "fact_checker")
+                }, poll_interval)
+                
+                status.write("📝 Submitted review batch...")
+                reviews = await self.run_batch_phase(status, job, "reviews", {
+                    f"{i}-critic": ("critic", self.PROMPTS["critic"].format(
+                        task=task,
+                        draft=drafts[f"{i}-writer"]["response"],
+                        fact_check=drafts[f"{i}-fact_checker"]["response"]
+                    ))
+                    for i, task in enumerate(tasks)
+                }, poll_interval)
+                
+                for i in range(len(tasks)):
+                    results[i] = [
+                        {"agent": "researcher", "output": research[f"{i}-researcher"]},
+                        {"agent": "writer", "output": drafts[f"{i}-writer"]},
+                        {"agent": "fact_checker", "output": drafts[f"{i}-fact_checker"]},
+                        {"agent": "critic", "output": reviews[f"{i}-critic"]}
+                    ]
+                
+                status.update(label="Batch completed!", state="complete")
+            
+            except Exception as e:
+                status.update(label=f"Error: {str(e)}", state="error")
+                st.error(f"Batch error: {str(e)}")
+                return []
+        
+        return results
 
-def create_agent_card(agent_name: str, thoughts: str, response: str):
+@st.cache_resource
+def load_encoder():
+    """Load the sentence embedding model once per server, if it is installed"""
+    if SentenceTransformer is None:
+        return None
+    return SentenceTransformer("all-MiniLM-L6-v2")
+
+@st.cache_resource
+def get_history_store() -> HistoryStore:
+    return HistoryStore()
+
+def get_system(api_key: str) -> MultiAgentSystem:
+    """Reuse one MultiAgentSystem per session so its HTTP connection pool and agent history survive reruns"""
+    # Keep the cache in session state so it survives Streamlit reruns
+    if "semantic_cache" not in st.session_state:
+        st.session_state["semantic_cache"] = SemanticCache(encoder=load_encoder())
+    
+    if st.session_state.get("system_api_key") != api_key:
+        st.session_state["system"] = MultiAgentSystem(
+            api_key,
+            cache=st.session_state["semantic_cache"],
+            history=get_history_store()
+        )
+        st.session_state["system_api_key"] = api_key
+    
+    system = st.session_state["system"]
+    system.set_session(st.session_state["session_id"])
+    return system
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """One event loop per session; the client's pooled connections are bound to the loop that opened them"""
+    if "event_loop" not in st.session_state:
+        st.session_state["event_loop"] = asyncio.new_event_loop()
+    return st.session_state["event_loop"]
+
+async def render_updates(queue: asyncio.Queue, show_update: Callable[[str, str, str], None]):
+    """Apply queued agent updates from one task, drawing only the newest value per card field"""
+    while True:
+        latest = {}
+        notes = []
+        update = await queue.get()
+        # Drain whatever else piled up while concurrent agents were streaming
+        while update is not None:
+            agent_key, field, value = update
+            if agent_key == STATUS_UPDATE:
+                # Progress notes are a log, so every one is shown rather than just the newest
+                notes.append(update)
+            else:
+                latest[(agent_key, field)] = value
+            if queue.empty():
+                break
+            update = queue.get_nowait()
+        
+        for note in notes:
+            show_update(*note)
+        for (agent_key, field), value in latest.items():
+            show_update(agent_key, field, value)
+        
+        if update is None:
+            return
+
+def create_agent_card(agent_name: str, thoughts: str = "", response: str = "") -> Dict:
     with st.container():
         st.subheader(f"🤖 {agent_name}")
         with st.expander("Show agent's thoughts", expanded=True):
             st.write("💭 **Thoughts:**")
-            st.write(thoughts)
+            thoughts_placeholder = st.empty()
+            thoughts_placeholder.write(thoughts)
         st.write("📄 **Response:**")
-        st.write(response)
+        response_placeholder = st.empty()
+        response_placeholder.write(response)
         st.divider()
+    
+    # Placeholders let streamed fields be filled in as they arrive
+    return {"thoughts": thoughts_placeholder, "response": response_placeholder}
 
 async def main():
     st.set_page_config(
@@ -150,15 +870,49 @@ async def main():
     
     st.title("🤖 Multi-Agent Collaboration System")
     st.markdown("""
-    This system demonstrates collaboration between three AI agents:
+    This system demonstrates collaboration between four AI agents:
     - 🔍 **Researcher**: Analyzes tasks and provides key information
     - ✍️ **Writer**: Creates content based on research findings
+    - 🔎 **Fact Checker**: Verifies the research while the Writer works
     - 📝 **Critic**: Reviews and provides feedback on the content
     """)
     
+    if "session_id" not in st.session_state:
+        st.session_state["session_id"] = uuid.uuid4().hex
+    
     with st.sidebar:
         st.header("Configuration")
         api_key = st.text_input("Enter Anthropic API Key:", type="password")
+        batch_mode = st.checkbox(
+            "Batch mode",
+            help="Run one task per line through the Message Batches API. About half the cost, but results can take minutes."
+        )
+        st.text_input(
+            "Session ID:",
+            key="session_id",
+            help="Results are saved under this ID. Paste an earlier ID and press Resume to reload that session."
+        )
+        resume = st.button("Resume session")
+        with st.expander("Models"):
+            model_options = sorted(set(MultiAgentSystem.MODELS.values()))
+            models = {}
+            max_tokens = {}
+            for agent_key, default in MultiAgentSystem.MODELS.items():
+                label = agent_key.replace("_", " ").title()
+                models[agent_key] = st.selectbox(
+                    label,
+                    model_options,
+                    index=model_options.index(default),
+                    key=f"model_{agent_key}"
+                )
+                max_tokens[agent_key] = st.slider(
+                    f"{label} max tokens",
+                    min_value=100,
+                    max_value=4000,
+                    value=MultiAgentSystem.MAX_TOKENS[agent_key],
+                    step=50,
+                    key=f"max_tokens_{agent_key}"
+                )
         st.divider()
         st.markdown("""
         ### How it works
@@ -172,35 +926,140 @@ async def main():
         st.warning("Please enter your Anthropic API key in the sidebar to continue.")
         return
     
-    system = MultiAgentSystem(api_key)
+    system = get_system(api_key)
+    system.configure(models, max_tokens)
+    
+    if resume:
+        rows = system.history.load(st.session_state["session_id"])
+        if rows:
+            st.header("Session history")
+            for agent_key, thoughts, response in rows:
+                create_agent_card(agent_key.replace("_", " ").title(), thoughts, response)
+        else:
+            st.info("No saved results for this session yet.")
     
     task = st.text_area(
-        "Enter your task:",
+        "Enter your tasks, one per line:" if batch_mode else "Enter your task:",
         placeholder="e.g., Explain the theory of relativity",
         height=100
     )
     
-    if st.button("Run Workflow", type="primary"):
-        if not task:
-            st.error("Please enter a task.")
+    run_clicked = st.button("Run Workflow", type="primary")
+    if run_clicked and not task:
+        st.error("Please enter a task.")
+        return
+    
+    if run_clicked and batch_mode:
+        batch_tasks = [line.strip() for line in task.splitlines() if line.strip()]
+        if "batch_job" in st.session_state:
+            st.info("A batch is already running for this session; resuming it instead of submitting a new one.")
+        elif not batch_tasks:
+            st.error("Please enter at least one task.")
+            return
+        else:
+            st.session_state["batch_job"] = {
+                "tasks": batch_tasks,
+                "batch_ids": {},
+                "outputs": {}
+            }
+    
+    # A rerun (any widget interaction) restarts the script, so pick an unfinished batch back up
+    if "batch_job" in st.session_state:
+        if st.button("Discard pending batch"):
+            try:
+                await system.cancel_batch(st.session_state["batch_job"])
+                st.info("Canceled the pending batch.")
+            except Exception as e:
+                st.warning(f"Stopped tracking the pending batch, but it could not be canceled: {str(e)}")
+            del st.session_state["batch_job"]
             return
+    
+    if "batch_job" in st.session_state and not batch_mode:
+        st.info("A batch is still pending for this session; turn on Batch mode to resume it.")
+    elif "batch_job" in st.session_state:
+        job = st.session_state["batch_job"]
+        batch_results = []
+        try:
+            batch_results = await system.run_batch(job)
+            
+            if batch_results:
+                st.header("Results")
+                for batch_task, results in zip(job["tasks"], batch_results):
+                    st.subheader(f"📌 {batch_task}")
+                    for result in results:
+                        create_agent_card(
+                            result["agent"].replace("_", " ").title(),
+                            result["output"]["thoughts"],
+                            result["output"]["response"]
+                        )
         
+        except Exception as e:
+            st.error(f"An error occurred: {str(e)}")
+            st.error("Please check your API key and try again.")
+        
+        # Keep the job (and its batch ids) after an error or interruption so the next run resumes it
+        if batch_results:
+            del st.session_state["batch_job"]
+        return
+    
+    if run_clicked:
         try:
-            with st.spinner("Processing your request..."):
-                results = await system.run_workflow(task)
+            status_area = st.container()
+            results_area = st.container()
+            cards = {}
+            
+            def show_update(agent_key: str, field: str, value: str):
+                if agent_key == STATUS_UPDATE or field == "error":
+                    with status_area:
+                        if field == "error":
+                            st.error(value)
+                        else:
+                            st.write(value)
+                    return
+                if agent_key not in cards:
+                    with results_area:
+                        if not cards:
+                            st.header("Results")
+                        cards[agent_key] = create_agent_card(agent_key.replace("_", " ").title())
+                if field in cards[agent_key]:
+                    cards[agent_key][field].write(value)
+            
+            # Agents only enqueue updates, so gathered calls never wait on Streamlit; one task renders them
+            updates = asyncio.Queue()
+            renderer = asyncio.create_task(render_updates(updates, show_update))
+            try:
+                with status_area:
+                    with st.spinner("Processing your request..."):
+                        results = await system.run_workflow(task, on_update=lambda *update: updates.put_nowait(update))
+            finally:
+                updates.put_nowait(None)
+                await renderer
             
             if results:
-                st.header("Results")
                 for result in results:
-                    create_agent_card(
-                        result["agent"].title(),
-                        result["output"]["thoughts"],
-                        result["output"]["response"]
-                    )
+                    show_update(result["agent"], "thoughts", result["output"]["thoughts"])
+                    show_update(result["agent"], "response", result["output"]["response"])
+                
+                with st.expander("Token usage"):
+                    for result in results:
+                        agent_name = result["agent"].replace("_", " ").title()
+                        usage = result["output"].get("usage")
+                        if usage:
+                            st.write(
+                                f"**{agent_name}**: {usage.input_tokens} input, "
+                                f"{getattr(usage, 'cache_read_input_tokens', None) or 0} read from prompt cache, "
+                                f"{getattr(usage, 'cache_creation_input_tokens', None) or 0} written to prompt cache, "
+                                f"{usage.output_tokens} output"
+                            )
+                        else:
+                            st.write(f"**{agent_name}**: no API usage (cached response or failed call)")
                     
         except Exception as e:
             st.error(f"An error occurred: {str(e)}")
             st.error("Please check your API key and try again.")
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    # asyncio.run() would close the loop after every rerun, dropping the cached client's connections
+    loop = get_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(main())
\ No newline at end of file